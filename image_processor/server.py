@@ -1,44 +1,186 @@
+from collections import OrderedDict
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import hashlib
 import logging
+import multiprocessing
+import os
+import threading
 import grpc
-import time
 
 from src.generated import processing_pb2
 from src.generated import processing_pb2_grpc
-from src.shared.image_processing import calculate_average_intensity
+from src.shared.image_processing import calculate_average_intensity, warmup
+
+# Decoding and reduction are CPU-bound, so run them in worker processes to use
+# all cores while the event loop keeps multiplexing RPC IO. The pool never
+# replaces a worker that dies, so a crashed worker breaks it for good and the
+# server shuts down to be restarted.
+CPU_COUNT = os.cpu_count() or 1
+_FORK_CONTEXT = multiprocessing.get_context('fork')
+PROCESS_POOL = futures.ProcessPoolExecutor(max_workers=CPU_COUNT, mp_context=_FORK_CONTEXT)
+
+# Inherited by every worker when it forks; see start_workers()
+_START_BARRIER = _FORK_CONTEXT.Barrier(CPU_COUNT)
+
+# Bound the number of images being decoded at once so bursts of large uploads
+# cannot exhaust memory, and give up on any single image that takes too long.
+MAX_INFLIGHT = int(os.environ.get('MAX_INFLIGHT', CPU_COUNT))
+ANALYSIS_TIMEOUT_SECONDS = float(os.environ.get('ANALYSIS_TIMEOUT_SECONDS', 10))
+MAX_CONCURRENT_RPCS = int(os.environ.get('MAX_CONCURRENT_RPCS', 2 * CPU_COUNT))
+
+# gRPC's default 4 MB receive limit is below the gateway's upload limit
+MAX_MESSAGE_LENGTH = int(os.environ.get('GRPC_MAX_MESSAGE_LENGTH', 16 * 1024 * 1024))
+SERVER_OPTIONS = [
+    ('grpc.so_reuseport', 1),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+
+_RESP_CLS = processing_pb2.AnalysisResponse
+
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 512))
+
+
+class ResultCache:
+    """A thread-safe LRU cache of analysis results keyed by image content."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_data, allowed_formats):
+        """Builds a cache key from the image bytes and the allowed formats."""
+        digest = hashlib.blake2b(image_data, digest_size=16)
+        digest.update(','.join(sorted(allowed_formats)).encode())
+        return digest.digest()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
 
 class ImageProcessorServicer(processing_pb2_grpc.ImageProcessorServicer):
     """Provides methods that implement functionality of image processor server."""
 
-    def AnalyzeImage(self, request, context):
-        """Processes the image and returns the analysis."""
+    def __init__(self):
+        self.result_cache = ResultCache(RESULT_CACHE_SIZE)
+        self.inflight = asyncio.BoundedSemaphore(MAX_INFLIGHT)
+        # Set once a worker process has died and the pool cannot be used
+        self.pool_broken = asyncio.Event()
+
+    async def _analyze(self, image_data, allowed_formats):
+        """Runs one analysis in the process pool, holding an in-flight slot."""
+        # A timeout cannot stop a worker mid-decode; it keeps running until the
+        # image is done. The slot is therefore released when the worker
+        # finishes rather than when the RPC gives up, so images that time out
+        # still count against MAX_INFLIGHT while they occupy a worker.
+        await self.inflight.acquire()
         try:
-            result = calculate_average_intensity(request.image_data, request.allowed_formats)
-            return processing_pb2.AnalysisResponse(
-                average_intensity=result["average_intensity"],
-                width=result["image_size"][0],
-                height=result["image_size"][1],
-                original_mode=result["original_mode"],
-                pixel_count=result["pixel_count"],
+            future = asyncio.get_running_loop().run_in_executor(
+                PROCESS_POOL, calculate_average_intensity, image_data, allowed_formats
             )
+        except BaseException:
+            self.inflight.release()
+            raise
+        future.add_done_callback(lambda _: self.inflight.release())
+        # Shield the worker's future so the timeout does not mark it done early
+        return await asyncio.wait_for(asyncio.shield(future), timeout=ANALYSIS_TIMEOUT_SECONDS)
+
+    async def AnalyzeImage(self, request, context):
+        """Processes the image and returns the analysis."""
+        try:
+            allowed_formats = list(request.allowed_formats)
+            # Hashing up to GRPC_MAX_MESSAGE_LENGTH bytes would stall every other
+            # RPC on the event loop; hashlib releases the GIL on large inputs.
+            cache_key = await asyncio.to_thread(ResultCache.make_key, request.image_data, allowed_formats)
+            result = self.result_cache.get(cache_key)
+            if result is None:
+                result = await self._analyze(request.image_data, allowed_formats)
+                self.result_cache.put(cache_key, result)
+            response = _RESP_CLS()
+            response.average_intensity = result["average_intensity"]
+            response.width, response.height = result["image_size"]
+            response.original_mode = result["original_mode"]
+            response.pixel_count = result["pixel_count"]
+            return response
         except ValueError as e:
             context.set_details(str(e))
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-            return processing_pb2.AnalysisResponse()
+            return _RESP_CLS()
+        except asyncio.TimeoutError:
+            # RESOURCE_EXHAUSTED is left to grpc.aio's maximum_concurrent_rpcs
+            # rejections, so the gateway can tell the two apart
+            logging.warning(f"Image analysis timed out after {ANALYSIS_TIMEOUT_SECONDS}s.")
+            context.set_details(f"Image analysis exceeded {ANALYSIS_TIMEOUT_SECONDS}s time limit")
+            context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+            return _RESP_CLS()
+        except BrokenProcessPool:
+            logging.critical("A process pool worker died; the pool can no longer run analyses.")
+            self.pool_broken.set()
+            context.set_details("Image processor is restarting")
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            return _RESP_CLS()
 
-def serve():
+def _wait_for_all_workers():
+    """Blocks a worker until every worker in the pool has reached this call."""
+    _START_BARRIER.wait(timeout=60)
+
+def start_workers():
+    """Forks every process pool worker before the gRPC server starts."""
+    # The pool forks no workers until tasks are submitted. Forking after
+    # gRPC has started its threads is unsafe, and a worker forked on a
+    # request makes that request pay for process startup, so fork them all
+    # up front, while the only other threads are the executor's own. Each
+    # task holds its worker at a barrier until all CPU_COUNT tasks are
+    # running, so no worker goes idle and picks up a second task, and the
+    # pool has to fork one process per task.
+    pending = [PROCESS_POOL.submit(_wait_for_all_workers) for _ in range(CPU_COUNT)]
+    for future in pending:
+        future.result()
+
+async def serve():
     """Starts the gRPC server."""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    processing_pb2_grpc.add_ImageProcessorServicer_to_server(ImageProcessorServicer(), server)
+    start_workers()
+    server = grpc.aio.server(
+        migration_thread_pool=futures.ThreadPoolExecutor(max_workers=4),
+        maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS,
+        options=SERVER_OPTIONS,
+    )
+    servicer = ImageProcessorServicer()
+    processing_pb2_grpc.add_ImageProcessorServicer_to_server(servicer, server)
     server.add_insecure_port('[::]:50051')
-    server.start()
+    await server.start()
     logging.info("Image Processor gRPC server started on port 50051.")
     try:
-        while True:
-            time.sleep(86400)
-    except KeyboardInterrupt:
-        server.stop(0)
+        # Runs until interrupted, or until the pool breaks and the process
+        # has to exit so that it is restarted with a fresh pool
+        await servicer.pool_broken.wait()
+        raise SystemExit(1)
+    finally:
+        await server.stop(0)
+        PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    serve()
+    # Warm Pillow once, before start_workers() forks the pool, so every
+    # worker inherits the loaded plugins instead of warming up itself
+    warmup()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
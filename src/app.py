@@ -1,24 +1,141 @@
-from flask import Flask, request, jsonify, render_template, g, current_app, has_request_context, Response as FlaskResponse
-from PIL import Image
-import numpy as np
-import io
+from flask import Flask, abort, request, jsonify, render_template, g, current_app, has_request_context, Response as FlaskResponse
+from flask.json.provider import JSONProvider
 import os
+import atexit
+import socket
 import logging
 import time
-import json
-import uuid
+import orjson
+import itertools
 import hashlib
+import queue
+import threading
 import redis
 from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Response
-from typing import Any, Dict, Tuple
+from typing import IO, Any, Dict, List, Optional, Tuple
 from flask_cors import CORS
 from .config import get_config_by_name
 import grpc
 from .generated import processing_pb2, processing_pb2_grpc
-from .shared.image_processing import calculate_average_intensity
+from .shared.image_processing import calculate_average_intensity, warmup
 
 
+# Redis counters for cache effectiveness. Every lookup that completes without
+# finding an entry counts as a miss, whether or not a result is later cached,
+# so hits = lookups - misses.
+CACHE_LOOKUPS_KEY = "image_intensity:stats:lookups"
+CACHE_MISSES_KEY = "image_intensity:stats:misses"
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# A per-process counter prefixed with the PID replaces a uuid4 (and its urandom
+# call). PID plus counter is only unique within a host, since every container
+# hands its workers the same small PIDs, so the hostname is prefixed as well.
+_HOSTNAME = socket.gethostname()
+_request_counter = itertools.count()
+_request_id_prefix = f"{_HOSTNAME}-{os.getpid():x}-"
+
+def _reset_request_ids() -> None:
+    """Restarts the request ID sequence in a freshly forked worker process."""
+    global _request_counter, _request_id_prefix
+    _request_counter = itertools.count()
+    _request_id_prefix = f"{_HOSTNAME}-{os.getpid():x}-"
+
+os.register_at_fork(after_in_child=_reset_request_ids)
+
+def next_request_id() -> str:
+    """Returns a request ID that is unique across hosts and worker processes."""
+    return f"{_request_id_prefix}{next(_request_counter):x}"
+
+def elapsed_ms() -> float:
+    """Returns the time spent on the current request so far, in milliseconds."""
+    return round((time.time() - g.start_time) * 1000, 2)
+
+def read_and_hash(stream: IO[bytes]) -> Tuple[bytes, str]:
+    """
+    Reads an upload stream to the end while hashing it.
+    
+    Each chunk is hashed while it is still in the CPU cache, so the upload is
+    walked once rather than read in full and then scanned again by the hash.
+    
+    Args:
+        stream: The binary stream of the uploaded file.
+    
+    Returns:
+        A tuple of the complete file contents and the hex digest used as the
+        cache key.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    chunks = []
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b''.join(chunks), digest.hexdigest()
+
+def analyze_remotely(image_data: bytes, allowed_formats: List[str]) -> Dict[str, Any]:
+    """
+    Analyzes an image by calling the Image Processor service over gRPC.
+    
+    Args:
+        image_data: The raw binary data of the image.
+        allowed_formats: The image formats the processor should accept.
+    
+    Returns:
+        The analysis in the same shape as `calculate_average_intensity`.
+    
+    Raises:
+        grpc.RpcError: If the call fails or the image is rejected.
+    """
+    # Round-robin across the channel pool
+    stub = current_app.grpc_stubs[next(current_app.grpc_counter) % len(current_app.grpc_stubs)]
+    analysis_request = processing_pb2.ImageRequest()
+    analysis_request.image_data = image_data
+    analysis_request.allowed_formats.extend(allowed_formats)
+    response = stub.AnalyzeImage(
+        analysis_request,
+        timeout=current_app.config['GRPC_TIMEOUT_SECONDS']
+    )
+    return {
+        'average_intensity': response.average_intensity,
+        'image_size': [response.width, response.height],
+        'original_mode': response.original_mode,
+        'pixel_count': response.pixel_count,
+    }
+
+class ProcessorBusyError(Exception):
+    """Raised when no in-process analysis slot frees up in time."""
+
+def analyze_locally(image_data: bytes, allowed_formats: List[str]) -> Dict[str, Any]:
+    """
+    Analyzes an image in the gateway process.
+    
+    At most `INPROCESS_MAX_INFLIGHT` images are decoded at once, mirroring the
+    processor's `MAX_INFLIGHT` bound. Unlike the processor, a decode running
+    on a request thread cannot be abandoned, so only the wait for a free slot
+    is time-limited.
+    
+    Args:
+        image_data: The raw binary data of the image.
+        allowed_formats: The image formats to accept.
+    
+    Returns:
+        The analysis from `calculate_average_intensity`.
+    
+    Raises:
+        ProcessorBusyError: If no slot frees up within `INPROCESS_WAIT_SECONDS`.
+        ValueError: If the image is rejected.
+    """
+    if not current_app.inprocess_slots.acquire(timeout=current_app.config['INPROCESS_WAIT_SECONDS']):
+        raise ProcessorBusyError("Too many images are being analyzed; try again later")
+    try:
+        return calculate_average_intensity(image_data, allowed_formats)
+    finally:
+        current_app.inprocess_slots.release()
+
 def make_error_response(message: str, status_code: int, **kwargs: Any) -> Tuple[FlaskResponse, int]:
     """Creates a standardized JSON error response."""
     payload: Dict[str, Any] = {"error": message}
@@ -27,6 +144,133 @@ def make_error_response(message: str, status_code: int, **kwargs: Any) -> Tuple[
     payload.update(kwargs)
     return jsonify(payload), status_code
 
+class CacheWriter:
+    """
+    Stores computed results in Redis, optionally off the request path.
+    
+    Results and cache-miss counts submitted while `CACHE_ASYNC_WRITES` is
+    enabled are queued and written by a daemon thread, which drains whatever
+    has accumulated and stores it in a single pipelined round trip. The
+    thread is started on first use, in the process that uses it, so workers
+    forked from a preloaded app get their own. When the queue is full the
+    entry is written synchronously instead. Cache writes are best effort: if
+    Redis is unavailable the entry is dropped and the error is logged.
+    
+    Queue entries are `(key, value)` pairs to store, or `None` for a miss.
+    """
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        # Threads do not survive fork, so a forked child starts from an empty
+        # queue and launches its own writer thread when it first needs one.
+        self._queue: queue.Queue = queue.Queue(maxsize=self.app.config['CACHE_WRITE_QUEUE_SIZE'])
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._run, name="cache-writer", daemon=True)
+                    thread.start()
+                    self._thread = thread
+
+    def flush(self) -> None:
+        """Blocks until every queued entry has been written or dropped."""
+        self._queue.join()
+
+    def submit(self, key: str, value: bytes) -> None:
+        """Stores a result, in the background when async writes are enabled."""
+        self._enqueue((key, value))
+
+    def record_miss(self) -> None:
+        """Counts a cache miss, in the background when async writes are enabled."""
+        self._enqueue(None)
+
+    def _enqueue(self, entry: Optional[Tuple[str, bytes]]) -> None:
+        if not self.app.config['CACHE_ASYNC_WRITES']:
+            self.write([entry])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.app.logger.warning("Cache write queue full; writing synchronously.")
+            self.write([entry])
+
+    def write(self, entries: List[Optional[Tuple[str, bytes]]]) -> None:
+        """Stores results and counts misses from a batch in one round trip."""
+        stored = [entry for entry in entries if entry is not None]
+        misses = len(entries) - len(stored)
+        try:
+            pipe = self.app.redis_client.pipeline(transaction=False)
+            if misses:
+                pipe.incrby(CACHE_MISSES_KEY, misses)
+            for key, value in stored:
+                pipe.setex(key, self.app.config['CACHE_TTL_SECONDS'], value)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            self.app.logger.error(f"Redis error on cache SET: {e}")
+
+    def _run(self) -> None:
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.app.config['CACHE_WRITE_BATCH_SIZE']:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(entries)
+            except Exception:
+                # Keep the writer alive; an unexpected error only loses this batch
+                self.app.logger.exception("Unexpected error in cache writer; dropping batch.")
+            finally:
+                for _ in entries:
+                    self._queue.task_done()
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson.
+    
+    Installed as `app.json` so that `jsonify` and `Response.get_json` use
+    orjson, which is several times faster than the standard library on the
+    small dictionaries this service returns.
+    """
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+def make_intensity_response(result: Dict[str, Any], filename: str, cache_status: str) -> FlaskResponse:
+    """
+    Builds the /intensity response from an analysis result.
+    
+    The per-request fields are added to the result and the whole body is
+    serialized once with orjson.
+    
+    Args:
+        result: The analysis result, as computed or decoded from the cache.
+        filename: The name of the uploaded file.
+        cache_status: The value for the `X-Cache` header ('hit' or 'miss').
+    
+    Returns:
+        A JSON response containing the analysis and per-request metadata.
+    """
+    body = orjson.dumps({
+        **result,
+        'filename': filename,
+        'request_id': g.request_id,
+        'duration_ms': elapsed_ms(),
+    })
+    response = current_app.response_class(body, mimetype='application/json')
+    response.headers['X-Cache'] = cache_status
+    return response
+
 # --- Structured Logging Setup ---
 
 class JsonFormatter(logging.Formatter):
@@ -47,7 +291,7 @@ class JsonFormatter(logging.Formatter):
             log_record['request_id'] = g.request_id
         if hasattr(record, 'extra_info'):
             log_record.update(record.extra_info)
-        return json.dumps(log_record)
+        return orjson.dumps(log_record).decode()
 
 def setup_logging(app: Flask) -> None:
     """
@@ -72,7 +316,7 @@ def setup_logging(app: Flask) -> None:
     werkzeug_logger.handlers = [handler]
     werkzeug_logger.setLevel(logging.WARNING)
 
-def create_app() -> Flask:
+def create_app(config_name: Optional[str] = None) -> Flask:
     """
     Creates and configures the Flask application.
     
@@ -80,25 +324,65 @@ def create_app() -> Flask:
     environment variables, sets up logging, and registers request hooks,
     routes, and error handlers.
     
+    Args:
+        config_name: The configuration to load (e.g., 'testing'). Defaults to
+            the `FLASK_ENV` environment variable, or 'development'.
+    
     Returns:
         The configured Flask application instance.
     """
     app = Flask(__name__, template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates'), static_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static'), static_url_path='/static')
 
+    app.json = OrjsonProvider(app)
+
     # --- CORS ---
     CORS(app)
 
     # --- Configuration ---
     # Load configuration from environment variable (e.g., 'development', 'production')
-    config_name = os.environ.get('FLASK_ENV', 'development')
+    if config_name is None:
+        config_name = os.environ.get('FLASK_ENV', 'development')
     app.config.from_object(get_config_by_name(config_name))
 
     # --- Redis Cache ---
+    # redis-py parses replies with hiredis automatically when it is installed
     app.redis_client = redis.Redis(
         host=app.config['REDIS_HOST'],
         port=app.config['REDIS_PORT'],
-        decode_responses=True
+        decode_responses=False,
+        max_connections=app.config['REDIS_MAX_CONNECTIONS']
     )
+    app.cache_writer = CacheWriter(app)
+
+    # --- gRPC Client ---
+    # A small pool of long-lived channels is shared by all requests so each
+    # call does not pay for a new TCP/HTTP2 handshake and stub construction.
+    # Each channel gets its own subchannel pool, and therefore its own TCP
+    # connection, so concurrent calls are spread across independent HTTP/2
+    # stream limits and flow-control windows.
+    app.grpc_channels = [
+        grpc.insecure_channel(
+            app.config['GRPC_SERVER_ADDRESS'],
+            options=[
+                ('grpc.max_send_message_length', app.config['GRPC_MAX_MESSAGE_LENGTH']),
+                ('grpc.keepalive_time_ms', 30000),
+                ('grpc.use_local_subchannel_pool', 1),
+            ]
+        )
+        for _ in range(app.config['GRPC_CHANNEL_POOL_SIZE'])
+    ]
+    app.grpc_stubs = [processing_pb2_grpc.ImageProcessorStub(channel) for channel in app.grpc_channels]
+    app.grpc_counter = itertools.count()
+    for channel in app.grpc_channels:
+        atexit.register(channel.close)
+
+    # Opting in to in-process compute avoids two protobuf serializations and
+    # a round trip, at the cost of decoding untrusted images in the gateway.
+    app.local_compute = app.config['INPROCESS_COMPUTE']
+    app.inprocess_slots = threading.BoundedSemaphore(app.config['INPROCESS_MAX_INFLIGHT'])
+    if app.local_compute:
+        # Load the decoders now rather than on the first request
+        warmup()
 
     # --- Logging ---
     setup_logging(app)
@@ -107,41 +391,35 @@ def create_app() -> Flask:
     @app.before_request
     def before_request_logging():
         g.start_time = time.time()
-        g.request_id = str(uuid.uuid4())
-        app.logger.info(
-            "Incoming request",
-            extra={'extra_info': {
-                "method": request.method,
-                "path": request.path,
-                "ip": request.remote_addr
-            }}
-        )
+        g.request_id = next_request_id()
+        # Skip building the log context entirely when INFO is filtered out
+        if app.logger.isEnabledFor(logging.INFO):
+            app.logger.info(
+                "Incoming request",
+                extra={'extra_info': {
+                    "method": request.method,
+                    "path": request.path,
+                    "ip": request.remote_addr
+                }}
+            )
 
     @app.after_request
     def after_request_logging(response: Response) -> Response:
         duration = time.time() - g.start_time
         if hasattr(g, 'request_id'):
             response.headers['X-Request-ID'] = g.request_id
-
-        # Add duration to JSON responses
-        if response.is_json:
-            try:
-                data = response.get_json()
-                if isinstance(data, dict):
-                    data['duration_ms'] = round(duration * 1000, 2)
-                    response.set_data(json.dumps(data))
-            except Exception as e:
-                current_app.logger.error(f"Failed to add duration to JSON response: {e}")
-
-        app.logger.info(
-            "Request completed",
-            extra={'extra_info': {
-                "method": request.method,
-                "path": request.path,
-                "status_code": response.status_code,
-                "duration_ms": round(duration * 1000, 2)
-            }}
-        )
+        response.headers['X-Duration-Ms'] = str(round(duration * 1000, 2))
+
+        if app.logger.isEnabledFor(logging.INFO):
+            app.logger.info(
+                "Request completed",
+                extra={'extra_info': {
+                    "method": request.method,
+                    "path": request.path,
+                    "status_code": response.status_code,
+                    "duration_ms": round(duration * 1000, 2)
+                }}
+            )
         return response
 
     # --- Routes and Error Handlers ---
@@ -159,6 +437,9 @@ def register_routes_and_handlers(app: Flask) -> None:
     Args:
         app: The Flask application instance.
     """
+    # Read once here rather than per request; sorted so every gateway process
+    # sends the formats to the image processor in the same order.
+    allowed_formats = sorted(app.config['ALLOWED_IMAGE_FORMATS'])
     
     @app.route('/')
     def index():
@@ -184,6 +465,12 @@ def register_routes_and_handlers(app: Flask) -> None:
             average intensity, image dimensions, and other metadata.
             On error, returns a JSON object with an error description.
         """
+        # Reject oversized uploads from the header alone, before any of the
+        # body is parsed or read into memory
+        content_length = request.content_length
+        if content_length is not None and content_length > current_app.config['MAX_CONTENT_LENGTH']:
+            abort(413)
+
         try:
             if 'image' not in request.files:
                 app.logger.warning("Validation failed: No image file provided.")
@@ -195,71 +482,67 @@ def register_routes_and_handlers(app: Flask) -> None:
                 app.logger.warning("Validation failed: No file selected.")
                 return make_error_response("No file selected", 400)
             
-            image_data = file.read()
+            image_data, image_hash = read_and_hash(file.stream)
             
             if not image_data:
                 app.logger.warning(f"Validation failed: Empty file uploaded. Filename: {file.filename}")
                 return make_error_response("Empty file uploaded", 400)
 
             # --- Caching Logic ---
-            image_hash = hashlib.sha256(image_data).hexdigest()
             cache_key = f"image_intensity:{image_hash}"
 
             try:
-                cached_result = current_app.redis_client.get(cache_key)
+                # Count the lookup in the same round trip as the GET
+                pipe = current_app.redis_client.pipeline(transaction=False)
+                pipe.get(cache_key)
+                pipe.incr(CACHE_LOOKUPS_KEY)
+                cached_result, _ = pipe.execute()
                 if cached_result:
-                    current_app.logger.info(f"Cache hit for image hash: {image_hash}")
-                    response = jsonify(json.loads(cached_result))
-                    response.headers['X-Cache'] = 'hit'
-                    return response, 200
+                    current_app.logger.info("Cache hit for image hash: %s", image_hash)
+                    return make_intensity_response(orjson.loads(cached_result), file.filename, 'hit'), 200
+                # Count the miss now, even if the image is rejected or not cached
+                current_app.cache_writer.record_miss()
             except redis.exceptions.RedisError as e:
                 current_app.logger.error(f"Redis error on cache GET: {e}")
 
-            current_app.logger.info(f"Cache miss for image hash: {image_hash}")
+            current_app.logger.info("Cache miss for image hash: %s", image_hash)
             
-            allowed_formats = current_app.config['ALLOWED_IMAGE_FORMATS']
-
             try:
-                with grpc.insecure_channel(current_app.config['GRPC_SERVER_ADDRESS']) as channel:
-                    stub = processing_pb2_grpc.ImageProcessorStub(channel)
-                    response = stub.AnalyzeImage(processing_pb2.ImageRequest(image_data=image_data, allowed_formats=allowed_formats))
-
-                result = {
-                    'average_intensity': response.average_intensity,
-                    'image_size': [response.width, response.height],
-                    'original_mode': response.original_mode,
-                    'pixel_count': response.pixel_count,
-                    'filename': file.filename,
-                    'request_id': g.request_id,
-                    'image_size_bytes': len(image_data),
-                }
+                if current_app.local_compute:
+                    analysis = analyze_locally(image_data, allowed_formats)
+                else:
+                    analysis = analyze_remotely(image_data, allowed_formats)
+
+                # Only fields that depend on the image content are cached;
+                # per-request fields are added when the response is built.
+                result = {**analysis, 'image_size_bytes': len(image_data)}
 
                 # --- Cache the result ---
-                try:
-                    current_app.redis_client.setex(
-                        cache_key,
-                        current_app.config['CACHE_TTL_SECONDS'],
-                        json.dumps(result)
+                current_app.cache_writer.submit(cache_key, orjson.dumps(result))
+
+                if app.logger.isEnabledFor(logging.INFO):
+                    app.logger.info(
+                        "Successfully calculated image intensity.",
+                        extra={'extra_info': {
+                            "filename": file.filename,
+                            "intensity": result['average_intensity'],
+                            "image_size_bytes": len(image_data)
+                        }}
                     )
-                except redis.exceptions.RedisError as e:
-                    current_app.logger.error(f"Redis error on cache SET: {e}")
-
-                app.logger.info(
-                    "Successfully calculated image intensity.",
-                    extra={'extra_info': {
-                        "filename": file.filename,
-                        "intensity": result['average_intensity'],
-                        "image_size_bytes": len(image_data)
-                    }}
-                )
-                response = jsonify(result)
-                response.headers['X-Cache'] = 'miss'
-                return response, 200
+                return make_intensity_response(result, file.filename, 'miss'), 200
+
+            except ProcessorBusyError as e:
+                app.logger.warning(f"In-process analysis rejected: {e}")
+                return make_error_response(f"Error processing image: {e}", 503)
 
             except grpc.RpcError as e:
                 app.logger.error(f"gRPC error during intensity calculation: {e.details()}")
                 if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
                     return make_error_response(f"Error processing image: {e.details()}", 400)
+                elif e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                    return make_error_response(f"Error processing image: {e.details()}", 503)
+                elif e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+                    return make_error_response(f"Error processing image: {e.details()}", 504)
                 else:
                     return make_error_response(f"Error processing image: {e.details()}", 500)
             
@@ -334,7 +617,7 @@ def register_routes_and_handlers(app: Flask) -> None:
             req_id = g.request_id
         
         # Create a JSON response
-        response.data = json.dumps({
+        response.data = orjson.dumps({
             "code": e.code,
             "name": e.name,
             "description": e.description,
@@ -14,13 +14,35 @@ class Config:
     # Set a maximum content length for uploads, defaulting to 5MB
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 5 * 1024 * 1024))
     # Define allowed image formats from an environment variable
-    ALLOWED_IMAGE_FORMATS = os.environ.get('ALLOWED_IMAGE_FORMATS', 'PNG,JPEG').split(',')
+    ALLOWED_IMAGE_FORMATS = frozenset(
+        image_format.strip().upper()
+        for image_format in os.environ.get('ALLOWED_IMAGE_FORMATS', 'PNG,JPEG').split(',')
+    )
     GRPC_SERVER_ADDRESS = os.environ.get('GRPC_SERVER_ADDRESS', 'localhost:50051')
+    # Compute intensity in the gateway process instead of calling the image
+    # processor. Off by default, so untrusted images are only decoded by the
+    # processor, which bounds and times out its work.
+    INPROCESS_COMPUTE = os.environ.get('INPROCESS_COMPUTE', 'false').lower() == 'true'
+    # Images decoded in-process at once per gateway worker, and how long a
+    # request waits for a free slot before it is rejected with a 503
+    INPROCESS_MAX_INFLIGHT = int(os.environ.get('INPROCESS_MAX_INFLIGHT', os.cpu_count() or 1))
+    INPROCESS_WAIT_SECONDS = float(os.environ.get('INPROCESS_WAIT_SECONDS', 5))
+    # Deadline for a single AnalyzeImage call, in seconds
+    GRPC_TIMEOUT_SECONDS = float(os.environ.get('GRPC_TIMEOUT_SECONDS', 15))
+    GRPC_MAX_MESSAGE_LENGTH = int(os.environ.get('GRPC_MAX_MESSAGE_LENGTH', 16 * 1024 * 1024))
+    # Number of independent gRPC connections requests are spread across
+    GRPC_CHANNEL_POOL_SIZE = int(os.environ.get('GRPC_CHANNEL_POOL_SIZE', 4))
 
     # Redis Cache Configuration
     REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
     REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+    # Upper bound on pooled Redis connections per worker process
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 64))
     CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 24 * 3600))  # 24 hours
+    # Write cache entries from a background thread so responses do not wait on Redis
+    CACHE_ASYNC_WRITES = os.environ.get('CACHE_ASYNC_WRITES', 'true').lower() == 'true'
+    CACHE_WRITE_QUEUE_SIZE = int(os.environ.get('CACHE_WRITE_QUEUE_SIZE', 1024))
+    CACHE_WRITE_BATCH_SIZE = int(os.environ.get('CACHE_WRITE_BATCH_SIZE', 64))
 
 
 class DevelopmentConfig(Config):
@@ -55,6 +77,10 @@ class TestingConfig(Config):
     TESTING = True
     # Use a smaller size limit for tests to make them faster
     MAX_CONTENT_LENGTH = 500 * 1024  # 500 KB for testing
+    # Write cache entries synchronously so cache hits are deterministic
+    CACHE_ASYNC_WRITES = False
+    # Compute in-process so no image processor needs to be running
+    INPROCESS_COMPUTE = True
 
 
 # Dictionary to map environment names to configuration classes
@@ -1,30 +1,58 @@
 import io
-import numpy as np
-from PIL import Image
+from PIL import Image, ImageStat
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Union
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
 
-def calculate_average_intensity(image_data: bytes, allowed_formats: List[str]) -> Dict[str, Any]:
+# ITU-R 601-2 luma weights, as used by Pillow's convert('L')
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+# Leading magic bytes of the formats that can be identified without Pillow,
+# so that common disallowed formats are rejected by name without parsing
+FORMAT_SIGNATURES = {
+    'PNG': (b'\x89PNG\r\n\x1a\n',),
+    'JPEG': (b'\xff\xd8\xff',),
+    'GIF': (b'GIF87a', b'GIF89a'),
+    'TIFF': (b'II*\x00', b'MM\x00*'),
+    'BMP': (b'BM',),
+}
+
+# JPEGs are decoded at up to 1/JPEG_DRAFT_SCALE of their size per dimension
+JPEG_DRAFT_SCALE = 8
+
+def _sniff_format(image_data: Union[bytes, bytearray, memoryview]) -> Optional[str]:
+    """Identifies the image format from its magic bytes, if it is a known one."""
+    header = bytes(image_data[:8])
+    for image_format, signatures in FORMAT_SIGNATURES.items():
+        if header.startswith(signatures):
+            return image_format
+    return None
+
+def calculate_average_intensity(image_data: Union[bytes, bytearray, memoryview], allowed_formats: List[str]) -> Dict[str, Any]:
     """
     Calculates the average pixel intensity of an image.
     
     This function first validates the image format against a list of allowed
-    formats. It then converts the image to grayscale ('L' mode) to ensure a
-    consistent intensity calculation across different image types (e.g., RGB,
-    RGBA). The average intensity is computed from the pixel values of the
-    grayscale image.
+    formats. Intensity is always measured as grayscale ('L' mode) luma to
+    ensure a consistent result across different image types. For RGB and RGBA
+    images the per-channel means are combined with the luma weights directly,
+    and palette images weight each palette entry's luma by its frequency, which
+    avoids allocating an intermediate grayscale image; other modes are
+    converted to grayscale first. JPEG images are decoded directly to a
+    downsampled luma plane, so their intensity is a close approximation rather
+    than an exact full-resolution mean.
     
     Args:
-        image_data: The raw binary data of the image.
+        image_data: The raw binary data of the image. Any bytes-like object
+            is accepted; ``bytes`` is shared by ``io.BytesIO`` without a copy.
         allowed_formats: A list of uppercase strings representing the
             allowed image formats (e.g., ['PNG', 'JPEG']).
     
     Returns:
-        A dictionary containing the calculated average intensity, image
-        dimensions, the original color mode of the image, and the total
+        A dictionary containing the calculated average intensity, original
+        image dimensions, the original color mode of the image, and the total
         pixel count.
     
     Raises:
@@ -32,25 +60,85 @@ def calculate_average_intensity(image_data: bytes, allowed_formats: List[str]) -
             the image data is corrupted or cannot be processed.
     """
     try:
-        image = Image.open(io.BytesIO(image_data))
+        # Reject disallowed formats from the magic bytes before Pillow parses
+        # anything, and only let Pillow try the plugin for the sniffed format.
+        sniffed_format = _sniff_format(image_data)
+        if sniffed_format is None and set(allowed_formats) <= FORMAT_SIGNATURES.keys():
+            logger.warning(f"Image format not allowed: unrecognized signature. Allowed: {', '.join(allowed_formats)}")
+            raise ValueError(f"Image must be in one of the following formats: {', '.join(allowed_formats)}. Received: an unsupported or unrecognized format")
+        if sniffed_format is not None and sniffed_format not in allowed_formats:
+            logger.warning(f"Image format not allowed: {sniffed_format}. Allowed: {', '.join(allowed_formats)}")
+            raise ValueError(f"Image must be in one of the following formats: {', '.join(allowed_formats)}. Received: {sniffed_format}")
+
+        image = Image.open(io.BytesIO(image_data), formats=[sniffed_format] if sniffed_format else None)
         if image.format not in allowed_formats:
             logger.warning(f"Image format not allowed: {image.format}. Allowed: {', '.join(allowed_formats)}")
             raise ValueError(f"Image must be in one of the following formats: {', '.join(allowed_formats)}. Received: {image.format}")
         
         width, height = image.size
-        
-        grayscale_image = image.convert('L') if image.mode != 'L' else image
-        
-        img_array = np.array(grayscale_image)
-        average_intensity = float(np.mean(img_array))
+        original_mode = image.mode
+
+        if image.format == 'JPEG':
+            # Let libjpeg decode a downscaled luma plane directly; the mean is
+            # scale-invariant up to sampling error, so this is a close
+            # approximation at a fraction of the decode cost.
+            image.draft('L', (max(1, width // JPEG_DRAFT_SCALE), max(1, height // JPEG_DRAFT_SCALE)))
+
+        if image.mode in ('RGB', 'RGBA'):
+            # Luma is linear, so weighting the channel means matches averaging
+            # a converted image, up to the per-pixel integer rounding that
+            # convert('L') applies, without allocating one.
+            r, g, b = ImageStat.Stat(image).mean[:3]
+            average_intensity = LUMA_WEIGHTS[0] * r + LUMA_WEIGHTS[1] * g + LUMA_WEIGHTS[2] * b
+        elif image.mode == 'P':
+            # Weight each palette entry's luma by how often its index occurs,
+            # instead of expanding the palette into a full grayscale image.
+            # getpalette() is trimmed to the entries the image defines; like
+            # convert('L'), map any index past the end through Pillow's
+            # default grayscale ramp, where entry i is (i, i, i).
+            palette = image.getpalette() or []
+            palette_size = len(palette) // 3
+            total = 0.0
+            for index, count in enumerate(image.histogram()):
+                if count:
+                    if index < palette_size:
+                        r, g, b = palette[3 * index:3 * index + 3]
+                    else:
+                        r = g = b = index
+                    total += count * (LUMA_WEIGHTS[0] * r + LUMA_WEIGHTS[1] * g + LUMA_WEIGHTS[2] * b)
+            average_intensity = total / (width * height)
+        else:
+            # The first band of L and LA images is already luma, so only
+            # other modes need a converted grayscale copy.
+            grayscale_image = image if image.mode in ('L', 'LA') else image.convert('L')
+            # Reduce inside Pillow's C code instead of materializing a NumPy array
+            average_intensity = ImageStat.Stat(grayscale_image).mean[0]
         
         return {
             'average_intensity': round(average_intensity, 2),
             'image_size': [width, height],
-            'original_mode': image.mode,
+            'original_mode': original_mode,
             'pixel_count': width * height
         }
     
     except Exception as e:
         logger.error(f"Pillow image processing failed: {str(e)}", exc_info=True)
-        raise ValueError(f"Error processing image: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Error processing image: {str(e)}")
+
+def warmup(formats: Tuple[str, ...] = ('PNG', 'JPEG')) -> None:
+    """
+    Loads Pillow's format plugins and exercises their decoders once.
+    
+    Calling this in a parent process before it forks workers means the
+    plugin modules are imported once and shared copy-on-write, instead of
+    every worker paying the import cost on its first request. A process
+    that is not forked from a warm parent should call it at startup.
+    
+    Args:
+        formats: The image formats whose decoders should be warmed up.
+    """
+    Image.init()
+    for image_format in formats:
+        buffer = io.BytesIO()
+        Image.new('L', (1, 1)).save(buffer, format=image_format)
+        calculate_average_intensity(buffer.getvalue(), [image_format])
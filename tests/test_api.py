@@ -1,98 +1,216 @@
 import pytest
-import sys
-import os
 import io
-from PIL import Image
-import numpy as np
+import struct
+import zlib
+import functools
+import itertools
+import threading
+from PIL import Image, ImageStat
 from unittest.mock import patch
 import fakeredis
+import grpc
 
-# Add project root to path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.app import CACHE_LOOKUPS_KEY, CACHE_MISSES_KEY, create_app
+from src.generated import processing_pb2
+from src.shared.image_processing import calculate_average_intensity
 
-from src.app import create_app, get_config_by_name
+# Only the size matters for the 413 check, so the content can be constant
+_OVERSIZE_BYTES = bytes(501 * 1024)
 
-@pytest.fixture
+# One in-memory Redis backend shared by every client the app creates
+_FAKE_SERVER = fakeredis.FakeServer()
+
+def _fake_redis(*args, **kwargs):
+    """Stand-in for redis.Redis that connects to the shared fake server."""
+    return fakeredis.FakeRedis(*args, server=_FAKE_SERVER, **kwargs)
+
+@pytest.fixture(scope="module")
 def app():
-    """Create and configure a new app instance for each test."""
-    # Patch redis.Redis with fakeredis.FakeRedis before creating the app
-    with patch('redis.Redis', fakeredis.FakeRedis):
-        app = create_app()
-        app.config.from_object(get_config_by_name('testing'))
+    """Create and configure one app instance shared by the tests in this module."""
+    # Patch redis.Redis with fakeredis before creating the app
+    with patch('redis.Redis', _fake_redis):
+        app = create_app('testing')
         yield app
 
+@pytest.fixture(autouse=True)
+def flush_cache():
+    """Start every test with an empty cache so results do not depend on test order."""
+    fakeredis.FakeRedis(server=_FAKE_SERVER).flushall()
+
 @pytest.fixture
 def client(app):
     """A test client for the app."""
     return app.test_client()
 
-def create_test_png(width=100, height=100, intensity=128):
-    """Create a test PNG image with specified intensity."""
-    img_array = np.full((height, width), intensity, dtype=np.uint8)
-    img = Image.fromarray(img_array, mode='L')
+def _png_chunk(chunk_type, data):
+    """Build a PNG chunk: length, type, data and CRC."""
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+@functools.lru_cache(maxsize=32)
+def _png_bytes(width, height, intensity, compression=-1):
+    """Build a constant-intensity 8-bit grayscale PNG without an encoder."""
+    # Each scanline is a filter-type byte (0 = none) followed by the pixels
+    scanlines = (b'\x00' + bytes([intensity]) * width) * height
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+        + _png_chunk(b'IDAT', zlib.compress(scanlines, compression))
+        + _png_chunk(b'IEND', b'')
+    )
+
+@functools.lru_cache(maxsize=32)
+def _jpeg_bytes(width, height, intensity):
+    """Encode a constant-intensity grayscale JPEG once per size and intensity."""
+    img = Image.new('L', (width, height), intensity)
     
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG')
+    return img_buffer.getvalue()
+
+def _encode_png(img):
+    """Encode a Pillow image as PNG bytes."""
     img_buffer = io.BytesIO()
     img.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
-    
-    return img_buffer
+    return img_buffer.getvalue()
+
+def create_test_png(width=100, height=100, intensity=128):
+    """Create a test PNG image with specified intensity."""
+    return io.BytesIO(_png_bytes(width, height, intensity))
 
 def create_test_jpeg(width=100, height=100, intensity=128):
     """Create a test JPEG image with specified intensity."""
-    img_array = np.full((height, width), intensity, dtype=np.uint8)
-    img = Image.fromarray(img_array, mode='L')
+    return io.BytesIO(_jpeg_bytes(width, height, intensity))
+
+
+class FakeRpcError(grpc.RpcError):
+    """A failed gRPC call with a status code and details."""
+
+    def __init__(self, code, details):
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+class FakeImageProcessorStub:
+    """Stand-in for ImageProcessorStub that records requests instead of calling a server."""
+
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.requests = []
+
+    def AnalyzeImage(self, request, timeout=None):
+        self.requests.append(request)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def _analysis_response():
+    """Build the AnalysisResponse the fake stubs return."""
+    return processing_pb2.AnalysisResponse(
+        average_intensity=127.5, width=20, height=10, original_mode='RGB', pixel_count=200
+    )
+
+
+@pytest.fixture
+def use_grpc(app, monkeypatch):
+    """Route analyses through fake gRPC stubs instead of computing them in-process."""
+    def install(*stubs):
+        monkeypatch.setattr(app, 'local_compute', False)
+        monkeypatch.setattr(app, 'grpc_stubs', list(stubs))
+        monkeypatch.setattr(app, 'grpc_counter', itertools.count())
+    return install
+
+
+def test_intensity_calculation():
+    """Test the intensity calculation function directly."""
+    result = calculate_average_intensity(_png_bytes(40, 30, 90), ['PNG'])
     
-    img_buffer = io.BytesIO()
-    img.save(img_buffer, format='JPEG')
-    img_buffer.seek(0)
+    assert result['average_intensity'] == 90.0
+    assert result['image_size'] == [40, 30]
+    assert result['original_mode'] == 'L'
+    assert result['pixel_count'] == 1200
+
+@pytest.mark.parametrize("mode,color", [
+    ('RGB', (10, 20, 30)),
+    # Alpha does not contribute to intensity
+    ('RGBA', (10, 20, 30, 128)),
+])
+def test_intensity_calculation_color(mode, color):
+    """Test that color images use the luma-weighted mean of their channels."""
+    image_data = _encode_png(Image.new(mode, (8, 6), color))
+    
+    result = calculate_average_intensity(image_data, ['PNG'])
     
-    return img_buffer
+    # 0.299 * 10 + 0.587 * 20 + 0.114 * 30, without convert('L')'s per-pixel
+    # rounding to 18
+    assert result['average_intensity'] == 18.15
+    assert result['original_mode'] == mode
+    assert result['pixel_count'] == 48
 
-def test_intensity_calculation(app):
-    """Test the intensity calculation function directly."""
-    # The function is now defined inside create_app, so we can't import it directly.
-    # We can test it through the endpoint, or by other means if we refactor.
-    # For now, we'll rely on the endpoint tests.
-    pass
+def test_intensity_calculation_palette():
+    """Test that palette images weight each entry's luma by its pixel count."""
+    img = Image.new('P', (4, 4), 0)
+    img.putpalette([10, 20, 30, 200, 100, 50])
+    # A quarter of the pixels use the second palette entry
+    img.paste(1, (0, 0, 4, 1))
+    
+    result = calculate_average_intensity(_encode_png(img), ['PNG'])
+    
+    # (3 * 18.15 + 124.2) / 4, from the luma of each palette entry
+    assert result['average_intensity'] == 44.66
+    assert result['original_mode'] == 'P'
 
-def test_intensity_endpoint_success_png(client):
-    """Test successful PNG image upload and intensity calculation."""
-    img_buffer = create_test_png(100, 100, 150)
+def test_intensity_calculation_palette_index_past_end():
+    """Test that indices beyond the palette are handled like convert('L') does."""
+    img = Image.new('P', (4, 4), 100)
+    # 17 entries keep the PNG at 8 bits per pixel, so index 100 survives
+    img.putpalette([0, 0, 0] * 17)
+    image_data = _encode_png(img)
     
-    response = client.post('/intensity', data={'image': (img_buffer, 'test.png')})
+    result = calculate_average_intensity(image_data, ['PNG'])
     
-    assert response.status_code == 200
-    assert 'X-Request-ID' in response.headers
-    data = response.get_json()
-    assert 'average_intensity' in data
-    assert data['average_intensity'] == 150.0
-    assert 'request_id' in data
+    expected = ImageStat.Stat(Image.open(io.BytesIO(image_data)).convert('L')).mean[0]
+    assert abs(result['average_intensity'] - expected) < 0.01
 
-def test_intensity_endpoint_success_jpeg(client):
-    """Test successful JPEG image upload and intensity calculation."""
-    img_buffer = create_test_jpeg(100, 100, 180)
+@pytest.mark.parametrize("factory,filename,intensity,tolerance", [
+    (create_test_png, 'test.png', 150, 0.01),
+    # JPEG compression can cause slight variations in intensity
+    (create_test_jpeg, 'test.jpg', 180, 2.0),
+])
+def test_intensity_endpoint_success(client, factory, filename, intensity, tolerance):
+    """Test successful image upload and intensity calculation for each format."""
+    img_buffer = factory(100, 100, intensity)
     
-    response = client.post('/intensity', data={'image': (img_buffer, 'test.jpg')})
+    response = client.post('/intensity', data={'image': (img_buffer, filename)})
     
     assert response.status_code == 200
     assert 'X-Request-ID' in response.headers
     data = response.get_json()
     assert 'average_intensity' in data
-    # JPEG compression can cause slight variations in intensity
-    assert abs(data['average_intensity'] - 180.0) < 2.0
+    assert abs(data['average_intensity'] - intensity) < tolerance
     assert 'request_id' in data
 
 def test_caching_logic(client):
     """Test that caching works as expected."""
+    # Both requests upload the same bytes
+    png_bytes = _png_bytes(50, 50, 100)
+
     # 1. First request: Cache Miss
-    response_miss = client.post('/intensity', data={'image': (create_test_png(50, 50, 100), 'test_cache.png')})
+    response_miss = client.post('/intensity', data={'image': (io.BytesIO(png_bytes), 'test_cache.png')})
     assert response_miss.status_code == 200
     assert response_miss.headers['X-Cache'] == 'miss'
     data_miss = response_miss.get_json()
     assert data_miss['average_intensity'] == 100.0
 
     # 2. Second request: Cache Hit
-    response_hit = client.post('/intensity', data={'image': (create_test_png(50, 50, 100), 'test_cache.png')})
+    response_hit = client.post('/intensity', data={'image': (io.BytesIO(png_bytes), 'test_cache.png')})
     assert response_hit.status_code == 200
     assert response_hit.headers['X-Cache'] == 'hit'
     data_hit = response_hit.get_json()
@@ -105,43 +223,65 @@ def test_caching_logic(client):
     data_hit.pop('duration_ms', None)
     assert data_miss == data_hit
 
+def test_caching_logic_async_writes(app, client, monkeypatch):
+    """Test that a result written by the background cache writer is served as a hit."""
+    monkeypatch.setitem(app.config, 'CACHE_ASYNC_WRITES', True)
+    png_bytes = _png_bytes(30, 30, 70)
+
+    response_miss = client.post('/intensity', data={'image': (io.BytesIO(png_bytes), 'async.png')})
+    assert response_miss.status_code == 200
+    assert response_miss.headers['X-Cache'] == 'miss'
+
+    # Wait for the writer thread to store everything queued so far
+    app.cache_writer.flush()
+
+    response_hit = client.post('/intensity', data={'image': (io.BytesIO(png_bytes), 'async.png')})
+    assert response_hit.headers['X-Cache'] == 'hit'
+    assert response_hit.get_json()['average_intensity'] == 70.0
+
+def test_cache_stats_count_rejected_upload_as_miss(client):
+    """Test that a lookup counts as a miss even when nothing gets cached."""
+    fake_gif = io.BytesIO(b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00;')
+    response = client.post('/intensity', data={'image': (fake_gif, 'test.gif')})
+    assert response.status_code == 400
+
+    stats = fakeredis.FakeRedis(server=_FAKE_SERVER)
+    assert int(stats.get(CACHE_LOOKUPS_KEY)) == 1
+    assert int(stats.get(CACHE_MISSES_KEY)) == 1
+
 def test_intensity_endpoint_no_file(client):
     """Test endpoint with no file uploaded."""
     response = client.post('/intensity')
     assert response.status_code == 400
-    data = response.get_json()
-    assert 'error' in data
-    assert 'request_id' in data
+    assert b'"error"' in response.data
+    assert b'"request_id"' in response.data
 
 def test_intensity_endpoint_empty_file(client):
     """Test endpoint with empty file."""
     response = client.post('/intensity', data={'image': (io.BytesIO(b''), 'empty.png')})
     assert response.status_code == 400
-    data = response.get_json()
-    assert 'error' in data
-    assert 'request_id' in data
+    assert b'"error"' in response.data
+    assert b'"request_id"' in response.data
 
 def test_intensity_endpoint_unsupported_format(client):
     """Test endpoint with an unsupported image format (GIF)."""
     fake_gif = io.BytesIO(b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
     response = client.post('/intensity', data={'image': (fake_gif, 'test.gif')})
     assert response.status_code == 400
-    data = response.get_json()
-    assert 'error' in data
-    assert 'request_id' in data
+    assert b'Received: GIF' in response.data
+    assert b'"request_id"' in response.data
 
 def test_404_endpoint(client):
     """Test 404 error handling."""
     response = client.get('/nonexistent')
     assert response.status_code == 404
-    data = response.get_json()
-    assert 'error' in data
-    assert 'request_id' in data
+    assert b'"error"' in response.data
+    assert b'"request_id"' in response.data
 
 def test_file_size_limit(client):
     """Test that uploading a file larger than the limit fails."""
     # TestingConfig sets the limit to 500 KB
-    large_buffer = io.BytesIO(os.urandom(501 * 1024))
+    large_buffer = io.BytesIO(_OVERSIZE_BYTES)
     
     response = client.post(
         '/intensity',
@@ -159,8 +299,9 @@ def test_file_just_under_size_limit(client):
     """Test that uploading a file just under the size limit succeeds."""
     # TestingConfig sets the limit to 500 KB
     # Create a PNG just under the limit (e.g., 499 KB)
-    # A 700x700 grayscale image is 490,000 bytes
-    img_buffer = create_test_png(width=700, height=700, intensity=100)
+    # A 700x700 grayscale image is 490,000 bytes; store it uncompressed so
+    # the upload really is that large
+    img_buffer = io.BytesIO(_png_bytes(700, 700, 100, compression=0))
     
     response = client.post(
         '/intensity',
@@ -173,6 +314,73 @@ def test_file_just_under_size_limit(client):
     data = response.get_json()
     assert 'average_intensity' in data
     assert data['average_intensity'] == 100.0
+
+def test_intensity_endpoint_grpc_success(client, use_grpc):
+    """Test that a result from the Image Processor is returned in the usual shape."""
+    stub = FakeImageProcessorStub(response=_analysis_response())
+    use_grpc(stub)
+    png_bytes = _png_bytes(20, 10, 50)
+
+    response = client.post('/intensity', data={'image': (io.BytesIO(png_bytes), 'remote.png')})
+
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'miss'
+    data = response.get_json()
+    assert data['average_intensity'] == 127.5
+    assert data['image_size'] == [20, 10]
+    assert data['original_mode'] == 'RGB'
+    assert data['pixel_count'] == 200
+    assert data['image_size_bytes'] == len(png_bytes)
+    assert data['filename'] == 'remote.png'
+    assert 'request_id' in data
+
+    request = stub.requests[0]
+    assert request.image_data == png_bytes
+    assert list(request.allowed_formats) == ['JPEG', 'PNG']
+
+def test_intensity_endpoint_grpc_round_robin(client, use_grpc):
+    """Test that calls are spread across the channel pool in turn."""
+    stubs = [FakeImageProcessorStub(response=_analysis_response()) for _ in range(2)]
+    use_grpc(*stubs)
+
+    for intensity in (10, 20, 30, 40):
+        image = io.BytesIO(_png_bytes(5, 5, intensity))
+        response = client.post('/intensity', data={'image': (image, 'test.png')})
+        assert response.status_code == 200
+
+    assert [len(stub.requests) for stub in stubs] == [2, 2]
+
+@pytest.mark.parametrize("code,status_code", [
+    (grpc.StatusCode.INVALID_ARGUMENT, 400),
+    (grpc.StatusCode.RESOURCE_EXHAUSTED, 503),
+    (grpc.StatusCode.DEADLINE_EXCEEDED, 504),
+    (grpc.StatusCode.UNAVAILABLE, 500),
+])
+def test_intensity_endpoint_grpc_errors(client, use_grpc, code, status_code):
+    """Test that Image Processor failures map to the documented HTTP statuses."""
+    use_grpc(FakeImageProcessorStub(error=FakeRpcError(code, 'processor failed')))
+
+    response = client.post('/intensity', data={'image': (create_test_png(), 'test.png')})
+
+    assert response.status_code == status_code
+    data = response.get_json()
+    assert 'processor failed' in data['error']
+    assert 'request_id' in data
+
+def test_intensity_endpoint_inprocess_busy(app, client, monkeypatch):
+    """Test that in-process analysis returns 503 when every slot stays busy."""
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(app, 'inprocess_slots', slots)
+    monkeypatch.setitem(app.config, 'INPROCESS_WAIT_SECONDS', 0)
+
+    response = client.post('/intensity', data={'image': (create_test_png(), 'test.png')})
+
+    assert response.status_code == 503
+    data = response.get_json()
+    assert 'error' in data
+    assert 'request_id' in data
+
 def test_generic_http_exception_handler(client):
     """Test the generic HTTPException handler for a 405 Method Not Allowed error."""
     response = client.get('/intensity')  # Send GET to a POST-only endpoint